@@ -3,37 +3,101 @@ from pathlib import Path
 from difflib import SequenceMatcher
 import re
 
+_WS_RE = re.compile(r"\s+")
+
 def norm(s: str) -> str:
     """Normalize by trimming, lowering, and collapsing spaces."""
-    return re.sub(r"\s+", " ", s.strip().lower())
+    return _WS_RE.sub(" ", s.strip().lower())
 
-def sim(a: str, b: str) -> float:
-    """Compute similarity using difflib ratio."""
-    return SequenceMatcher(None, norm(a), norm(b)).ratio()
+def sim(a: str, sm: SequenceMatcher, floor: float = 0.0) -> float:
+    """Compute similarity of normalized line a to the line held by sm.
 
-def best_line_map(old_lines, new_lines, threshold=0.75, monotone=True):
+    sm keeps its second sequence between calls, so difflib only indexes
+    each new line once. Returns 0.0 without running the full ratio when
+    the cheap upper bound shows the pair cannot score above ``floor``.
+    """
+    if a is sm.b or a == sm.b:
+        return 1.0
+    sm.set_seq1(a)
+    if sm.quick_ratio() <= floor:
+        return 0.0
+    return sm.ratio()
+
+def _ratio_bound(la: int, lb: int) -> float:
+    """Upper bound on ratio() for lines of lengths la and lb.
+
+    ratio() is at most 2*min(la, lb) / (la + lb), so length alone can rule
+    a line out before difflib compares it.
+    """
+    return 2.0 * min(la, lb) / (la + lb) if la + lb else 1.0
+
+def _map_monotone(norm_old, norm_new, sms, threshold):
     mapping = []
-    used = set()
+    used = bytearray(len(norm_new))
+    len_new = [len(nl) for nl in norm_new]
     j_start = 0
 
-    for i, old in enumerate(old_lines, 1):
+    for i, old in enumerate(norm_old, 1):
+        best_j, best_s = -1, 0.0
+        if j_start < len(norm_new) and not used[j_start] and old == norm_new[j_start]:
+            # Unchanged line: nothing later in the file can score higher.
+            best_j, best_s = j_start, 1.0
+        else:
+            la = len(old)
+            for j in range(j_start, len(norm_new)):
+                if used[j]:
+                    continue
+                bound = _ratio_bound(la, len_new[j])
+                if bound < threshold or bound <= best_s:
+                    continue
+                s = sim(old, sms[j], best_s)
+                if s > best_s:
+                    best_s, best_j = s, j
+        if best_s >= threshold:
+            mapping.append((i, best_j + 1))
+            if best_j >= 0:
+                used[best_j] = 1
+            j_start = best_j + 1
+        else:
+            mapping.append((i, -1))
+    return mapping, used
+
+def _map_free(norm_old, norm_new, sms, threshold):
+    mapping = []
+    used = bytearray(len(norm_new))
+    len_new = [len(nl) for nl in norm_new]
+
+    for i, old in enumerate(norm_old, 1):
         best_j, best_s = -1, 0.0
-        rng = range(j_start, len(new_lines)) if monotone else range(len(new_lines))
-        for j in rng:
-            if j in used:
+        la = len(old)
+        for j in range(len(norm_new)):
+            if used[j]:
+                continue
+            bound = _ratio_bound(la, len_new[j])
+            if bound < threshold or bound <= best_s:
                 continue
-            s = sim(old, new_lines[j])
+            s = sim(old, sms[j], best_s)
             if s > best_s:
                 best_s, best_j = s, j
         if best_s >= threshold:
             mapping.append((i, best_j + 1))
-            used.add(best_j)
-            if monotone:
-                j_start = best_j + 1
+            if best_j >= 0:
+                used[best_j] = 1
         else:
             mapping.append((i, -1))
     return mapping, used
 
+def best_line_map(old_lines, new_lines, threshold=0.75, monotone=True):
+    # With threshold <= 0 a line can "match" no line (best_j == -1). Nothing
+    # is marked used then, and the monotone scan restarts from j_start = 0,
+    # so used lines can still lie ahead of it.
+    norm_old = [norm(x) for x in old_lines]
+    norm_new = [norm(x) for x in new_lines]
+    sms = [SequenceMatcher(None, b=nl) for nl in norm_new]
+    if monotone:
+        return _map_monotone(norm_old, norm_new, sms, threshold)
+    return _map_free(norm_old, norm_new, sms, threshold)
+
 def main():
     ap = argparse.ArgumentParser(description="Git Diff -> W_BEST_LINE style output")
     ap.add_argument("old_file", type=Path)
@@ -41,8 +105,8 @@ def main():
     ap.add_argument("--threshold", type=float, default=0.75)
     args = ap.parse_args()
 
-    old_lines = args.old_file.read_text(encoding="utf-8", errors="replace").splitlines()
-    new_lines = args.new_file.read_text(encoding="utf-8", errors="replace").splitlines()
+    old_lines = args.old_file.read_bytes().decode("utf-8", "replace").splitlines()
+    new_lines = args.new_file.read_bytes().decode("utf-8", "replace").splitlines()
 
     mapping, used_new = best_line_map(old_lines, new_lines, threshold=args.threshold)
 
@@ -59,7 +123,7 @@ def main():
             print(f"OLD {i}")
 
     # Print unmatched additions
-    new_only = [j+1 for j in range(len(new_lines)) if j not in used_new]
+    new_only = [j+1 for j in range(len(new_lines)) if not used_new[j]]
     if new_only:
         print("\n# Unmatched additions (only in NEW file):")
         for j in new_only:
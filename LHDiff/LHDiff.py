@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
+import os
 import sys
 import re
 import math
 import string
+import bisect
+import hashlib
 import difflib
+import heapq
 from collections import Counter
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from typing import List, Dict, Set, Tuple
 
-SIMHASH_BITS = 64
 K_CANDIDATES = 15
 SIM_THRESHOLD = 0.35
 SPLIT_THRESHOLD = 0.65
 MERGE_THRESHOLD = 0.65
+# Scoring costs roughly 33us per (old line, candidate) pair, and a spawned
+# pool (the Windows/macOS default) about 0.35s to start, so the pool only
+# pays off with two or more CPUs from about 20k pairs.
+PARALLEL_MIN_PAIRS = 20000
 
 KEYWORDS = {
     "if", "else", "for", "while", "return", "class", "def", "try", "except",
@@ -19,13 +29,11 @@ KEYWORDS = {
     "lambda", "yield", "in", "not", "and", "or"
 }
 
+_PUNCT_TABLE = str.maketrans('', '', ''.join(ch for ch in string.punctuation if ch not in "{}"))
+_NON_WORD_RE = re.compile(r"[^a-z0-9_]+")
+
 def preprocess_line(line: str) -> str:
-    line = line.rstrip("\n").lower()
-    punctuation_to_remove = ''.join(ch for ch in string.punctuation if ch not in "{}")
-    table = str.maketrans('', '', punctuation_to_remove)
-    line = line.translate(table)
-    line = re.sub(r"\s+", " ", line)
-    return line.strip()
+    return " ".join(line.lower().translate(_PUNCT_TABLE).split())
 
 
 def preprocess_file(lines):
@@ -38,7 +46,7 @@ def is_blank_pre(line: str) -> bool:
 def structural_tokens(line: str) -> List[str]:
     if not line:
         return []
-    raw = re.split(r"[^a-z0-9_]+", line)
+    raw = _NON_WORD_RE.split(line)
     t = []
     for tok in raw:
         if not tok:
@@ -56,210 +64,301 @@ def structural_string(line: str) -> str:
     return " ".join(structural_tokens(line))
 
 
-def build_context(pre_lines, idx, window=4):
-    n = len(pre_lines)
-    parts = []
-
-    cnt = 0
-    j = idx - 1
-    while j >= 0 and cnt < window:
-        if not is_blank_pre(pre_lines[j]):
-            parts.append(pre_lines[j])
-            cnt += 1
-        j -= 1
-
-    cnt = 0
-    j = idx + 1
-    while j < n and cnt < window:
-        if not is_blank_pre(pre_lines[j]):
-            parts.append(pre_lines[j])
-            cnt += 1
-        j += 1
+def lev_pattern(a):
+    """Bit mask of the positions of each character of a, for lev_bits()."""
+    peq = {}
+    bit = 1
+    for ch in a:
+        peq[ch] = peq.get(ch, 0) | bit
+        bit <<= 1
+    return peq
 
-    return " ".join(parts)
 
-
-def levenshtein(a, b):
-    if a == b:
-        return 0
-    la, lb = len(a), len(b)
+def lev_bits(peq, la, b):
+    """Bit-parallel edit distance between a and b, given lev_pattern(a) and len(a)."""
     if la == 0:
-        return lb
-    if lb == 0:
-        return la
-
-    prev = list(range(lb + 1))
-    cur = [0] * (lb + 1)
-
-    for i in range(1, la + 1):
-        cur[0] = i
-        ca = a[i - 1]
-        for j in range(1, lb + 1):
-            cb = b[j - 1]
-            cost = 0 if ca == cb else 1
-            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
-        prev, cur = cur, prev
-
-    return prev[lb]
-
-
-def norm_lev(a, b):
-    if not a and not b:
+        return len(b)
+    mask = (1 << la) - 1
+    high = 1 << (la - 1)
+    pv, mv, d = mask, 0, la
+    for ch in b:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            d += 1
+        elif mh & high:
+            d -= 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return d
+
+
+def norm_lev(a, b, floor=0.0, peq=None):
+    if a == b:
         return 1.0
     if not a or not b:
         return 0.0
-    d = levenshtein(a, b)
     m = max(len(a), len(b))
+    max_d = int((1.0 - floor) * m + 1e-9) if floor > 0 else None
+    if max_d is not None and m - min(len(a), len(b)) > max_d:
+        return 0.0
+    if peq is None:
+        peq = lev_pattern(a)
+    d = lev_bits(peq, len(a), b)
     return 1.0 - d / m
 
 
+def context_bags(pre_lines, window=4):
+    """Token counts and L2 norm of the nearest window non-blank lines around each line."""
+    line_tokens = [s.split() for s in pre_lines]
+    nonblank = [k for k, s in enumerate(pre_lines) if not is_blank_pre(s)]
+    bags = []
+    for idx in range(len(pre_lines)):
+        lo = bisect.bisect_left(nonblank, idx)
+        hi = bisect.bisect_right(nonblank, idx)
+        around = nonblank[max(0, lo - window):lo] + nonblank[hi:hi + window]
+        counts = Counter(chain.from_iterable([line_tokens[k] for k in around]))
+        bags.append((counts, math.sqrt(sum(v * v for v in counts.values()))))
+    return bags
+
+
 def cosine(a, b):
-    if not a and not b:
+    (ca, na), (cb, nb) = a, b
+    if not ca and not cb:
         return 1.0
-    if not a or not b:
+    if not ca or not cb:
         return 0.0
-    ca = Counter(a.split())
-    cb = Counter(b.split())
-    dot = sum(ca[t] * cb.get(t, 0) for t in ca)
-    na = math.sqrt(sum(v * v for v in ca.values()))
-    nb = math.sqrt(sum(v * v for v in cb.values()))
+    if len(ca) > len(cb):
+        ca, cb = cb, ca
+    dot = sum(v * cb.get(t, 0) for t, v in ca.items())
     if na == 0 or nb == 0:
         return 0.0
     return dot / (na * nb)
 
 
-def combined(ca, cb, sa, sb, xa, xb):
-    return 0.5 * norm_lev(ca, cb) + 0.3 * norm_lev(sa, sb) + 0.2 * cosine(xa, xb)
+def combined(ca, cb, sa, sb, xa, xb, threshold=0.0, pc=None, ps=None):
+    """Weighted line similarity; may underestimate scores that cannot reach threshold."""
+    if ca == cb and sa == sb and xa == xb:
+        return 1.0
+    content_floor = (threshold - 0.5) / 0.5
+    return (0.5 * norm_lev(ca, cb, content_floor, pc) + 0.3 * norm_lev(sa, sb, peq=ps)
+            + 0.2 * cosine(xa, xb))
+
+
+def combined_candidates(ca, sa, xa, cands, pre_new, struct_new, ctx_new):
+    pc = lev_pattern(ca)
+    ps = lev_pattern(sa)
+    return [combined(ca, pre_new[j], sa, struct_new[j], xa, ctx_new[j], pc=pc, ps=ps)
+            for j in cands]
+
+
+_token_bits: Dict[str, Tuple[int, ...]] = {}
+
 
+def token_bits(tok: str) -> Tuple[int, ...]:
+    """Set bits of tok's 64-bit MD5 hash, which unlike hash() is stable across runs."""
+    bits = _token_bits.get(tok)
+    if bits is None:
+        h = int.from_bytes(hashlib.md5(tok.encode("utf-8")).digest()[:8], "big")
+        bits = _token_bits[tok] = tuple(i for i in range(64) if h >> i & 1)
+    return bits
 
-def simhash(tokens: List[str], bits=SIMHASH_BITS) -> int:
+
+def simhash64(tokens: List[str]) -> int:
     if not tokens:
         return 0
-    v = [0] * bits
-    for tok in tokens:
-        h = hash(tok)
-        for i in range(bits):
-            if (h >> i) & 1:
-                v[i] += 1
-            else:
-                v[i] -= 1
+    ones = [0] * 64
+    total = 0
+    for tok, n in Counter(tokens).items():
+        total += n
+        for i in token_bits(tok):
+            ones[i] += n
     x = 0
-    for i in range(bits):
-        if v[i] > 0:
-            x |= (1 << i)
+    for i in range(64):
+        if 2 * ones[i] > total:
+            x |= 1 << i
     return x
 
 
-def hamming(a, b):
-    x = a ^ b
-    c = 0
-    while x:
-        x &= x - 1
-        c += 1
-    return c
+def simhash_lines(structs: List[str]) -> List[int]:
+    seen = {}
+    out = []
+    for st in structs:
+        h = seen.get(st)
+        if h is None:
+            h = seen[st] = simhash64(st.split())
+        out.append(h)
+    return out
+
+
+def hamming64(a, b):
+    return (a ^ b).bit_count()
 
 
 def find_unchanged(pre_old, pre_new, blank_old, blank_new):
-    sm = difflib.SequenceMatcher(None, pre_old, pre_new, autojunk=False)
+    ids = {}
+    old_ids = [ids.setdefault(s, len(ids)) for s in pre_old]
+    new_ids = [ids.setdefault(s, len(ids)) for s in pre_new]
+    sm = difflib.SequenceMatcher(None, old_ids, new_ids, autojunk=False)
     m = {}
     for tag, i1, i2, j1, j2 in sm.get_opcodes():
         if tag == "equal":
             for k in range(i2 - i1):
                 oi = i1 + k
                 nj = j1 + k
-                if oi in blank_old or nj in blank_new:
+                if blank_old[oi] or blank_new[nj]:
                     continue
                 m[oi] = nj
     return m
 
 
-def compute_mapping(old_lines: List[str], new_lines: List[str]):
-    n_old = len(old_lines)
-    n_new = len(new_lines)
+@dataclass
+class PreFile:
+    pre: List[str]
+    blank: bytearray
+    struct: List[str]
+    ctx: List[Tuple[Counter, float]]
+    hashes: List[int]
+
+
+def prepare_file(lines: List[str]) -> PreFile:
+    pre = preprocess_file(lines)
+    struct = [structural_string(s) for s in pre]
+    return PreFile(
+        pre=pre,
+        blank=bytearray(is_blank_pre(s) for s in pre),
+        struct=struct,
+        ctx=context_bags(pre),
+        hashes=simhash_lines(struct),
+    )
+
+
+def group_by_hash(hashes: List[int], lines) -> List[Tuple[int, List[int]]]:
+    groups: Dict[int, List[int]] = {}
+    for j in lines:
+        groups.setdefault(hashes[j], []).append(j)
+    return list(groups.items())
+
+
+def score_row(old: PreFile, new: PreFile, free_groups, i):
+    """Screen free_groups by simhash for old line i and score the top candidates."""
+    hi = old.hashes[i]
+    dists = sorted(((hamming64(hi, h), js) for h, js in free_groups),
+                   key=lambda g: g[0])
+    pool = []
+    reach = 0
+    for d, js in dists:
+        if len(pool) >= K_CANDIDATES and d > reach:
+            break
+        pool.extend((-d, j) for j in js)
+        reach = d
+    sims = heapq.nlargest(K_CANDIDATES, pool)
+    cands = [j for _, j in sims]
+    return cands, combined_candidates(old.pre[i], old.struct[i], old.ctx[i],
+                                      cands, new.pre, new.struct, new.ctx)
 
-    pre_old = preprocess_file(old_lines)
-    pre_new = preprocess_file(new_lines)
 
-    blank_old = {i for i, s in enumerate(pre_old) if is_blank_pre(s)}
-    blank_new = {j for j, s in enumerate(pre_new) if is_blank_pre(s)}
+_worker_args = None
 
-    struct_old = [structural_string(s) for s in pre_old]
-    struct_new = [structural_string(s) for s in pre_new]
-    ctx_old = [build_context(pre_old, i) for i in range(n_old)]
-    ctx_new = [build_context(pre_new, j) for j in range(n_new)]
 
-    hash_old = [simhash(structural_tokens(s)) for s in pre_old]
-    hash_new = [simhash(structural_tokens(s)) for s in pre_new]
+def _init_worker(old, new, free_groups):
+    global _worker_args
+    _worker_args = (old, new, free_groups)
 
-    unchanged = find_unchanged(pre_old, pre_new, blank_old, blank_new)
-    used_old = set(unchanged.keys())
-    used_new = set(unchanged.values())
 
-    pairs = []
-    for i in range(n_old):
-        if i in used_old or i in blank_old:
-            continue
+def _score_row_worker(i):
+    return score_row(*_worker_args, i)
 
-        sims = []
-        hi = hash_old[i]
-        for j in range(n_new):
-            if j in used_new or j in blank_new:
-                continue
-            hd = hamming(hi, hash_new[j])
-            sims.append((1.0 - hd / SIMHASH_BITS, j))
 
-        if not sims:
-            continue
+def score_rows(old: PreFile, new: PreFile, free_groups, rows):
+    """score_row() for each old line in rows, in a process pool when the work is large."""
+    workers = os.cpu_count() or 1
+    if len(rows) * K_CANDIDATES < PARALLEL_MIN_PAIRS or workers < 2:
+        return [score_row(old, new, free_groups, i) for i in rows]
+    chunksize = max(1, len(rows) // (4 * workers))
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(old, new, free_groups)) as ex:
+        return list(ex.map(_score_row_worker, rows, chunksize=chunksize))
+
 
-        sims.sort(reverse=True)
-        for _, j in sims[:K_CANDIDATES]:
-            score = combined(pre_old[i], pre_new[j],
-                             struct_old[i], struct_new[j],
-                             ctx_old[i], ctx_new[j])
-            pairs.append((score, i, j))
+def compute_mapping(old: PreFile, new: PreFile):
+    n_old = len(old.pre)
+    n_new = len(new.pre)
+
+    pre_old, pre_new = old.pre, new.pre
+    blank_old, blank_new = old.blank, new.blank
+    struct_old, struct_new = old.struct, new.struct
+    ctx_old, ctx_new = old.ctx, new.ctx
+    hash_new = new.hashes
+
+    unchanged = find_unchanged(pre_old, pre_new, blank_old, blank_new)
+    used_old = bytearray(n_old)
+    used_new = bytearray(n_new)
+    for i, j in unchanged.items():
+        used_old[i] = 1
+        used_new[j] = 1
+
+    free_groups = group_by_hash(hash_new, (j for j in range(n_new)
+                                           if not used_new[j] and not blank_new[j]))
+
+    scored = {}
+    pairs = []
+    rows = [i for i in range(n_old) if not used_old[i] and not blank_old[i]]
+    for i, (cands, scores) in zip(rows, score_rows(old, new, free_groups, rows)):
+        for score, j in zip(scores, cands):
+            scored[i, j] = score
+            if score >= SIM_THRESHOLD:
+                pairs.append((score, i, j))
 
     pairs.sort(reverse=True)
     primary = dict(unchanged)
 
     for score, i, j in pairs:
-        if score < SIM_THRESHOLD:
-            break
-        if i in used_old or j in used_new:
+        if used_old[i] or used_new[j]:
             continue
         primary[i] = j
-        used_old.add(i)
-        used_new.add(j)
+        used_old[i] = 1
+        used_new[j] = 1
 
     mapping = {i: set() for i in range(n_old)}
     for i, j in primary.items():
         mapping[i].add(j)
 
     for i in range(n_old):
-        if not mapping[i] or i in blank_old:
+        if not mapping[i] or blank_old[i]:
             continue
-        j0 = sorted(mapping[i])[0]
+        j0 = min(mapping[i])
 
         for k in (j0 - 1, j0 + 1):
-            if 0 <= k < n_new and k not in mapping[i] and k not in blank_new:
-                score = combined(pre_old[i], pre_new[k],
-                                 struct_old[i], struct_new[k],
-                                 ctx_old[i], ctx_new[k])
+            if 0 <= k < n_new and k not in mapping[i] and not blank_new[k]:
+                score = scored.get((i, k))
+                if score is None:
+                    score = combined(pre_old[i], pre_new[k],
+                                     struct_old[i], struct_new[k],
+                                     ctx_old[i], ctx_new[k], SPLIT_THRESHOLD)
                 if score >= SPLIT_THRESHOLD:
                     mapping[i].add(k)
 
     for i in range(n_old):
-        if not mapping[i] or i in blank_old:
+        if not mapping[i] or blank_old[i]:
             continue
-        j0 = sorted(mapping[i])[0]
+        j0 = min(mapping[i])
 
         for nb in (i - 1, i + 1):
             if nb < 0 or nb >= n_old:
                 continue
-            if mapping[nb] or nb in blank_old:
+            if mapping[nb] or blank_old[nb]:
                 continue
-            score = combined(pre_old[nb], pre_new[j0],
-                             struct_old[nb], struct_new[j0],
-                             ctx_old[nb], ctx_new[j0])
+            score = scored.get((nb, j0))
+            if score is None:
+                score = combined(pre_old[nb], pre_new[j0],
+                                 struct_old[nb], struct_new[j0],
+                                 ctx_old[nb], ctx_new[j0], MERGE_THRESHOLD)
             if score >= MERGE_THRESHOLD:
                 mapping[nb].add(j0)
 
@@ -269,9 +368,9 @@ def compute_mapping(old_lines: List[str], new_lines: List[str]):
     return final
 
 
-def print_mapping(mapping, pre_old, pre_new):
+def print_mapping(mapping, blank_old, blank_new):
     for i in sorted(mapping.keys()):
-        if is_blank_pre(pre_old[i - 1]):
+        if blank_old[i - 1]:
             continue
         t = mapping[i]
         if not t:
@@ -282,37 +381,40 @@ def print_mapping(mapping, pre_old, pre_new):
             print(f"{i} -> {', '.join(str(x) for x in t)}")
 
     print("\n# Unmatched deletions (only in OLD file):")
-    dels = [i for i, t in mapping.items() if not t and not is_blank_pre(pre_old[i - 1])]
+    dels = [i for i, t in mapping.items() if not t and not blank_old[i - 1]]
     for d in dels:
         print(f"OLD {d}")
     if not dels:
         print("(none)")
 
     print("\n# Unmatched additions (only in NEW file):")
-    used_new = set()
+    used_new = bytearray(len(blank_new) + 1)
     for t in mapping.values():
-        used_new.update(t)
-    adds = [j for j in range(1, len(pre_new)+1)
-            if j not in used_new and not is_blank_pre(pre_new[j - 1])]
+        for j in t:
+            used_new[j] = 1
+    adds = [j for j in range(1, len(blank_new)+1)
+            if not used_new[j] and not blank_new[j - 1]]
     for a in adds:
         print(f"NEW {a}")
     if not adds:
         print("(none)")
 
 
+def read_lines(path):
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8").splitlines(True)
+
+
 def main():
     if len(sys.argv) != 3:
         print("Usage: python3 lhdiff.py <old> <new>")
         sys.exit(1)
 
-    old = open(sys.argv[1], encoding="utf-8").read().splitlines(True)
-    new = open(sys.argv[2], encoding="utf-8").read().splitlines(True)
-
-    pre_old = preprocess_file(old)
-    pre_new = preprocess_file(new)
+    old = prepare_file(read_lines(sys.argv[1]))
+    new = prepare_file(read_lines(sys.argv[2]))
 
     mapping = compute_mapping(old, new)
-    print_mapping(mapping, pre_old, pre_new)
+    print_mapping(mapping, old.blank, new.blank)
 
 
 if __name__ == "__main__":
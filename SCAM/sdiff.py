@@ -10,79 +10,82 @@ import sys
 import os
 import subprocess
 import tempfile
-from typing import Optional, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Iterable, Iterator, NamedTuple
 from difflib import SequenceMatcher
+from itertools import zip_longest
 
 # Constants
 PROGRAM_NAME = "sdiff"
 VERSION = "1.0.0"
 DEFAULT_WIDTH = 130
 DEFAULT_EDITOR = os.environ.get("EDITOR", "notepad.exe" if os.name == 'nt' else "vi")
+CHOICE_PROMPT = "\nChoice [l/r/e/el/er/eb/ed/s/v/q/?]: "
+EDIT_COMMANDS = frozenset(('e', 'e1', 'el', 'e2', 'er', 'eb', 'ed'))
+SEPARATORS = {'equal': '   ', 'replace': ' | ', 'delete': ' < ', 'insert': ' > '}
 
 # Global state
 tmpname: Optional[str] = None
-suppress_common_lines = False
 
 
-class DiffResult:
+class DiffResult(NamedTuple):
     """Represents a difference between two files"""
-    def __init__(self, tag: str, i1: int, i2: int, j1: int, j2: int):
-        self.tag = tag  # 'equal', 'replace', 'delete', 'insert'
-        self.i1 = i1
-        self.i2 = i2
-        self.j1 = j1
-        self.j2 = j2
-    
-    def left_lines(self) -> int:
-        return self.i2 - self.i1
-    
-    def right_lines(self) -> int:
-        return self.j2 - self.j1
+    tag: str  # 'equal', 'replace', 'delete', 'insert'
+    i1: int
+    i2: int
+    j1: int
+    j2: int
 
 
-def compute_diff(file1_lines: List[str], file2_lines: List[str]) -> List[DiffResult]:
+def compute_diff(file1_lines: List[str], file2_lines: List[str]) -> Iterator[DiffResult]:
     """Compute differences between two files using built-in difflib"""
-    matcher = SequenceMatcher(None, file1_lines, file2_lines)
-    results = []
+    # Identical files (the common case against an unchanged baseline) are a
+    # single equal run, or no hunks at all when empty; skip the matcher
+    if file1_lines == file2_lines:
+        if file1_lines:
+            yield DiffResult('equal', 0, len(file1_lines), 0, len(file2_lines))
+        return
     
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        results.append(DiffResult(tag, i1, i2, j1, j2))
+    # Diff small integer line ids: cheaper to hash than lines, and collision-free
+    ids = {}
+    left_ids = [ids.setdefault(line, len(ids)) for line in file1_lines]
+    right_ids = [ids.setdefault(line, len(ids)) for line in file2_lines]
+    matcher = SequenceMatcher(None, left_ids, right_ids)
+    
+    # Consumers walk the hunks once, so hand them out as they are needed
+    for op in matcher.get_opcodes():
+        yield DiffResult._make(op)
+
+
+def read_lines(path: str) -> List[str]:
+    """Read a file's lines the way text-mode readlines() does"""
+    with open(path, 'rb') as f:
+        data = f.read()
     
-    return results
+    # Text mode turns CRLF and lone CR into LF, and only LF ends a line
+    data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return [line.decode('utf-8', 'replace') for line in data.splitlines(keepends=True)]
+
 
+def display_lines(lines: List[str]) -> List[str]:
+    """Strip line endings once so every displayed hunk can reuse the result"""
+    return [line.rstrip('\n') for line in lines]
 
-def format_side_by_side(left_lines: List[str], right_lines: List[str], 
+
+def format_side_by_side(left_shown: List[str], right_shown: List[str],
                         diff: DiffResult, width: int) -> str:
-    """Format lines side-by-side for display"""
+    """Format lines side-by-side for display, given display_lines() output"""
     half_width = (width - 3) // 2
+    separator = SEPARATORS[diff.tag]
     output = []
     
-    left_content = left_lines[diff.i1:diff.i2] if diff.i1 < diff.i2 else []
-    right_content = right_lines[diff.j1:diff.j2] if diff.j1 < diff.j2 else []
-    
-    max_lines = max(len(left_content), len(right_content))
+    left_content = left_shown[diff.i1:diff.i2]
+    right_content = right_shown[diff.j1:diff.j2]
     
-    for i in range(max_lines):
-        left_line = left_content[i].rstrip('\n') if i < len(left_content) else ""
-        right_line = right_content[i].rstrip('\n') if i < len(right_content) else ""
-        
-        # Truncate or pad left side
+    for left_line, right_line in zip_longest(left_content, right_content, fillvalue=''):
+        # Truncate and pad left side, truncate right side
         left_display = left_line[:half_width].ljust(half_width)
-        
-        # Determine separator
-        if diff.tag == 'equal':
-            separator = "   "
-        elif diff.tag == 'replace':
-            separator = " | "
-        elif diff.tag == 'delete':
-            separator = " < "
-        else:  # insert
-            separator = " > "
-        
-        # Truncate right side
-        right_display = right_line[:half_width]
-        
-        output.append(f"{left_display}{separator}{right_display}")
+        output.append(f"{left_display}{separator}{right_line[:half_width]}")
     
     return '\n'.join(output)
 
@@ -106,9 +109,14 @@ Commands:
     print(help_text)
 
 
+def _terminated(lines: List[str]) -> str:
+    """Join lines into one block where every line ends with a newline"""
+    return ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
+
+
 def edit_conflict(left_lines: List[str], lname: str, lstart: int,
                  right_lines: List[str], rname: str, rstart: int,
-                 diff: DiffResult, cmd: str) -> Optional[str]:
+                 diff: DiffResult, cmd: str) -> Optional[bytes]:
     """Handle interactive editing of a conflict"""
     global tmpname
     
@@ -117,47 +125,36 @@ def edit_conflict(left_lines: List[str], lname: str, lstart: int,
         fd, tmpname = tempfile.mkstemp(prefix='sdiff_', suffix='.txt')
         os.close(fd)
     
+    left_content = left_lines[diff.i1:diff.i2]
+    right_content = right_lines[diff.j1:diff.j2]
+    parts = []
+    
+    # Collect content based on command
+    if cmd in ['ed', 'e1', 'el']:
+        # Left with optional header
+        if cmd == 'ed' and left_content:
+            if len(left_content) == 1:
+                parts.append(f"--- {lname} line {lstart + diff.i1 + 1}\n")
+            else:
+                parts.append(f"--- {lname} lines {lstart + diff.i1 + 1}-{lstart + diff.i2}\n")
+        parts.append(_terminated(left_content))
+    
+    if cmd in ['ed', 'e2', 'er']:
+        # Right with optional header
+        if cmd == 'ed' and right_content:
+            if len(right_content) == 1:
+                parts.append(f"+++ {rname} line {rstart + diff.j1 + 1}\n")
+            else:
+                parts.append(f"+++ {rname} lines {rstart + diff.j1 + 1}-{rstart + diff.j2}\n")
+        parts.append(_terminated(right_content))
+    
+    if cmd == 'eb':
+        # Both versions
+        parts.append(_terminated(left_content))
+        parts.append(_terminated(right_content))
+    
     with open(tmpname, 'w', encoding='utf-8') as tmp:
-        left_content = left_lines[diff.i1:diff.i2]
-        right_content = right_lines[diff.j1:diff.j2]
-        
-        # Write content based on command
-        if cmd in ['ed', 'e1', 'el']:
-            # Write left with optional header
-            if cmd == 'ed' and left_content:
-                if len(left_content) == 1:
-                    tmp.write(f"--- {lname} line {lstart + diff.i1 + 1}\n")
-                else:
-                    tmp.write(f"--- {lname} lines {lstart + diff.i1 + 1}-{lstart + diff.i2}\n")
-            
-            for line in left_content:
-                tmp.write(line)
-                if not line.endswith('\n'):
-                    tmp.write('\n')
-        
-        if cmd in ['ed', 'e2', 'er']:
-            # Write right with optional header
-            if cmd == 'ed' and right_content:
-                if len(right_content) == 1:
-                    tmp.write(f"+++ {rname} line {rstart + diff.j1 + 1}\n")
-                else:
-                    tmp.write(f"+++ {rname} lines {rstart + diff.j1 + 1}-{rstart + diff.j2}\n")
-            
-            for line in right_content:
-                tmp.write(line)
-                if not line.endswith('\n'):
-                    tmp.write('\n')
-        
-        if cmd == 'eb':
-            # Write both versions
-            for line in left_content:
-                tmp.write(line)
-                if not line.endswith('\n'):
-                    tmp.write('\n')
-            for line in right_content:
-                tmp.write(line)
-                if not line.endswith('\n'):
-                    tmp.write('\n')
+        tmp.write(''.join(parts))
     
     # Launch editor
     editor = os.environ.get('EDITOR', DEFAULT_EDITOR)
@@ -168,12 +165,18 @@ def edit_conflict(left_lines: List[str], lname: str, lstart: int,
     except FileNotFoundError:
         print(f"Error: Editor '{editor}' not found", file=sys.stderr)
         print(f"Set EDITOR environment variable or edit {tmpname} manually", file=sys.stderr)
-        input("Press Enter when done editing...")
+        # Same byte-level stdin as the merge loop; input() would buffer
+        # ahead and swallow the commands that follow
+        sys.stdout.write("Press Enter when done editing...")
+        sys.stdout.flush()
+        sys.stdin.buffer.readline()
     
-    # Read edited content
+    # Read edited content as bytes so the merge can take it as-is
     try:
-        with open(tmpname, 'r', encoding='utf-8') as tmp:
-            return tmp.read()
+        with open(tmpname, 'rb') as tmp:
+            data = tmp.read()
+        data.decode('utf-8')  # reject invalid UTF-8 as text mode would
+        return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
     except Exception as e:
         print(f"Error reading edited file: {e}", file=sys.stderr)
         return None
@@ -181,46 +184,50 @@ def edit_conflict(left_lines: List[str], lname: str, lstart: int,
 
 def interactive_merge(left_lines: List[str], lname: str,
                      right_lines: List[str], rname: str,
-                     diffs: List[DiffResult], width: int) -> Optional[str]:
-    """Perform interactive merge"""
-    global suppress_common_lines
-    
-    result = []
+                     diffs: Iterable[DiffResult], width: int,
+                     suppress_common_lines: bool = False) -> Optional[bytearray]:
+    """Perform interactive merge, returning the merged file as UTF-8 bytes"""
+    result = bytearray()
+    extend = result.extend
+    # Read commands straight from the byte stream rather than through
+    # input(), which sets up readline line editing on every prompt
+    readline = sys.stdin.buffer.readline
+    left_shown = display_lines(left_lines)
+    right_shown = display_lines(right_lines)
     
     for diff in diffs:
         if diff.tag == 'equal':
             # Identical lines
             if not suppress_common_lines:
-                print(format_side_by_side(left_lines, right_lines, diff, width))
+                print(format_side_by_side(left_shown, right_shown, diff, width))
             
             # Add to result
-            for line in left_lines[diff.i1:diff.i2]:
-                result.append(line)
+            extend(''.join(left_lines[diff.i1:diff.i2]).encode('utf-8'))
         
         else:
             # Conflict - requires user decision
             print("\n" + "=" * width)
             print("CONFLICT:")
-            print(format_side_by_side(left_lines, right_lines, diff, width))
+            print(format_side_by_side(left_shown, right_shown, diff, width))
             print("=" * width)
             
             # Get user command
             while True:
-                try:
-                    cmd = input("\nChoice [l/r/e/el/er/eb/ed/s/v/q/?]: ").strip().lower()
-                except EOFError:
+                sys.stdout.write(CHOICE_PROMPT)
+                sys.stdout.flush()
+                line = readline()
+                if not line:
                     return None
+                cmd = line.decode('utf-8', 'replace').strip().lower()
                 
                 if cmd in ['l', '1']:
                     # Use left version
-                    for line in left_lines[diff.i1:diff.i2]:
-                        result.append(line)
+                    extend(''.join(left_lines[diff.i1:diff.i2]).encode('utf-8'))
                     break
                 
                 elif cmd in ['r', '2']:
                     # Use right version
-                    for line in right_lines[diff.j1:diff.j2]:
-                        result.append(line)
+                    extend(''.join(right_lines[diff.j1:diff.j2]).encode('utf-8'))
                     break
                 
                 elif cmd == 's':
@@ -236,12 +243,12 @@ def interactive_merge(left_lines: List[str], lname: str,
                 elif cmd == 'q':
                     return None
                 
-                elif cmd in ['e', 'e1', 'el', 'e2', 'er', 'eb', 'ed']:
+                elif cmd in EDIT_COMMANDS:
                     edited = edit_conflict(left_lines, lname, 0,
                                           right_lines, rname, 0,
                                           diff, cmd)
                     if edited is not None:
-                        result.append(edited)
+                        extend(edited)
                         break
                     else:
                         print("Edit cancelled")
@@ -255,26 +262,27 @@ def interactive_merge(left_lines: List[str], lname: str,
                     print("Invalid command. Type ? for help.")
                     continue
     
-    return ''.join(result)
+    return result
 
 
 def simple_diff_display(left_lines: List[str], right_lines: List[str],
-                       diffs: List[DiffResult], width: int) -> None:
+                       diffs: Iterable[DiffResult], width: int,
+                       suppress_common_lines: bool = False) -> None:
     """Display differences without interaction"""
-    global suppress_common_lines
-    
+    left_shown = display_lines(left_lines)
+    right_shown = display_lines(right_lines)
     for diff in diffs:
         if diff.tag == 'equal' and suppress_common_lines:
             continue
         
-        output = format_side_by_side(left_lines, right_lines, diff, width)
+        output = format_side_by_side(left_shown, right_shown, diff, width)
         if output:
             print(output)
 
 
 def main() -> int:
     """Main entry point"""
-    global suppress_common_lines, tmpname
+    global tmpname
     
     import argparse
     
@@ -295,19 +303,19 @@ def main() -> int:
     
     args = parser.parse_args()
     
-    suppress_common_lines = args.suppress_common_lines
+    # Read input files concurrently; the GIL is released while blocked on I/O
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        left_future = pool.submit(read_lines, args.file1)
+        right_future = pool.submit(read_lines, args.file2)
     
-    # Read input files
     try:
-        with open(args.file1, 'r', encoding='utf-8', errors='replace') as f:
-            left_lines = f.readlines()
+        left_lines = left_future.result()
     except Exception as e:
         print(f"Error reading {args.file1}: {e}", file=sys.stderr)
         return 2
     
     try:
-        with open(args.file2, 'r', encoding='utf-8', errors='replace') as f:
-            right_lines = f.readlines()
+        right_lines = right_future.result()
     except Exception as e:
         print(f"Error reading {args.file2}: {e}", file=sys.stderr)
         return 2
@@ -315,15 +323,16 @@ def main() -> int:
     # Compute differences
     diffs = compute_diff(left_lines, right_lines)
     
-    # Check if files are identical
-    all_equal = all(d.tag == 'equal' for d in diffs)
+    # Every hunk is 'equal' exactly when the files are identical
+    all_equal = left_lines == right_lines
     
     try:
         if args.output:
             # Interactive mode
             result = interactive_merge(left_lines, args.file1,
                                      right_lines, args.file2,
-                                     diffs, args.width)
+                                     diffs, args.width,
+                                     args.suppress_common_lines)
             
             if result is None:
                 print("\nMerge cancelled", file=sys.stderr)
@@ -331,7 +340,10 @@ def main() -> int:
             
             # Write output
             try:
-                with open(args.output, 'w', encoding='utf-8') as f:
+                # Keep text mode's platform line endings
+                if os.linesep != '\n':
+                    result = result.replace(b'\n', os.linesep.encode())
+                with open(args.output, 'wb') as f:
                     f.write(result)
                 print(f"\nOutput written to {args.output}")
             except Exception as e:
@@ -340,7 +352,8 @@ def main() -> int:
         
         else:
             # Display-only mode
-            simple_diff_display(left_lines, right_lines, diffs, args.width)
+            simple_diff_display(left_lines, right_lines, diffs, args.width,
+                                args.suppress_common_lines)
     
     finally:
         # Cleanup temp file
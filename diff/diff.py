@@ -1,40 +1,46 @@
 #!/usr/bin/env python3
 
 import sys
+from itertools import zip_longest
 
 def read_file(path):
 
     try:
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            return [line.rstrip("\n") for line in f]
+        with open(path, "rb") as f:
+            data = f.read()
     except FileNotFoundError:
         print(f"Error: File not found -> {path}")
         sys.exit(1)
 
+    # bytes.splitlines() breaks on the same newlines as text mode
+    return [line.decode("utf-8", "replace") for line in data.splitlines()]
 
-def compare_files(file1_lines, file2_lines):
-    max_lines = max(len(file1_lines), len(file2_lines))
 
-    for i in range(max_lines):
-        # Handle cases where one file is shorter
-        line1 = file1_lines[i] if i < len(file1_lines) else None
-        line2 = file2_lines[i] if i < len(file2_lines) else None
+def compare_files(file1_lines, file2_lines):
+    out = []
 
+    # zip_longest pads the shorter file with None
+    for i, (line1, line2) in enumerate(zip_longest(file1_lines, file2_lines), 1):
         # Same line
         if line1 == line2:
-            print(f"  Line {i+1}: same    -> {line1}")
+            out.append(f"  Line {i}: same    -> {line1}")
 
         # Line added in file2
         elif line1 is None:
-            print(f"+ Line {i+1}: added   -> {line2}")
+            out.append(f"+ Line {i}: added   -> {line2}")
 
         # Line removed from file1
         elif line2 is None:
-            print(f"- Line {i+1}: removed -> {line1}")
+            out.append(f"- Line {i}: removed -> {line1}")
 
         # Line changed between files
         else:
-            print(f"~ Line {i+1}: changed from '{line1}' to '{line2}'")
+            out.append(f"~ Line {i}: changed from '{line1}' to '{line2}'")
+
+    # One write for the whole report instead of a print per line
+    if out:
+        out.append("")
+        sys.stdout.write("\n".join(out))
 
 
 def main():
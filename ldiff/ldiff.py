@@ -8,35 +8,38 @@ Given two versions of a file, outputs a sequence of line mappings:
 Optionally, with --show-unmatched, also prints pure additions/deletions.
 """
 
+import os
 import sys
 import math
+import re
 import difflib
 import argparse
 from collections import Counter
-from typing import List, Tuple, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict, Optional
+
+# Thinning costs roughly 6.5us per (old, new) line pair in the blocks, and a
+# spawned pool (the Windows/macOS default) about 0.35s to start, so the
+# pool only pays off with two or more CPUs from about 100k line pairs.
+PARALLEL_MIN_CELLS = 100000
 
 # ---------------------- Tokenization & TF-IDF ---------------------- #
 
+# \w is exactly str.isalnum() plus "_", and a newline never joins tokens
+_TOK_RE = re.compile(r"\w+")
+
+# A TF-IDF weight map together with its L2 norm, computed once per range
+TfidfVector = Tuple[Dict[str, float], float]
+
+
 def tokenize_line_range(lines: List[str]) -> List[str]:
-    tokens = []
-    for line in lines:
-        token = ""
-        for ch in line:
-            if ch.isalnum() or ch == "_":
-                token += ch
-            else:
-                if token:
-                    tokens.append(token)
-                    token = ""
-        if token:
-            tokens.append(token)
-    return tokens
+    return _TOK_RE.findall("\n".join(lines))
 
 
 def build_tfidf_vectors(
     ranges: List[Tuple[int, int]],
     all_lines: List[str]
-) -> Dict[Tuple[int, int], Dict[str, float]]:
+) -> Dict[Tuple[int, int], TfidfVector]:
     docs_tokens: Dict[Tuple[int, int], List[str]] = {}
     df: Counter = Counter()
 
@@ -48,7 +51,7 @@ def build_tfidf_vectors(
             df[t] += 1
 
     N = len(ranges)
-    vectors: Dict[Tuple[int, int], Dict[str, float]] = {}
+    vectors: Dict[Tuple[int, int], TfidfVector] = {}
 
     for key, tokens in docs_tokens.items():
         tf = Counter(tokens)
@@ -56,56 +59,90 @@ def build_tfidf_vectors(
         for t, f in tf.items():
             idf = math.log((N + 1.0) / (df[t] + 1.0)) + 1.0
             vec[t] = f * idf
-        vectors[key] = vec
+        vectors[key] = (vec, math.sqrt(sum(w * w for w in vec.values())))
 
     return vectors
 
 
-def cosine_similarity(vec1: Dict[str, float], vec2: Dict[str, float]) -> float:
-    if not vec1 or not vec2:
-        return 0.0
-    if len(vec1) < len(vec2):
-        smaller, larger = vec1, vec2
-    else:
-        smaller, larger = vec2, vec1
-    dot = 0.0
-    for t, w in smaller.items():
-        w2 = larger.get(t)
-        if w2 is not None:
-            dot += w * w2
-    norm1 = math.sqrt(sum(w * w for w in vec1.values()))
-    norm2 = math.sqrt(sum(w * w for w in vec2.values()))
-    if norm1 == 0.0 or norm2 == 0.0:
-        return 0.0
-    return dot / (norm1 * norm2)
-
-
 # ---------------- Normalized Levenshtein Distance ------------------ #
 
-def normalized_levenshtein(s1: str, s2: str) -> float:
+def lev_pattern(s: str) -> Dict[str, int]:
+    """Bit mask of the positions of each character of s, for lev_bits()."""
+    peq: Dict[str, int] = {}
+    bit = 1
+    for ch in s:
+        peq[ch] = peq.get(ch, 0) | bit
+        bit <<= 1
+    return peq
+
+
+def lev_bits(peq: Dict[str, int], len1: int, s2: str,
+             max_d: Optional[int] = None) -> int:
+    """Levenshtein distance of s1 and s2 from lev_pattern(s1) and len(s1).
+
+    Myers' bit-parallel algorithm: the whole DP column for s1 is packed
+    into integers, so each character of s2 costs a few big-int operations
+    instead of an inner loop over s1.
+
+    With max_d set, gives up once the distance is sure to exceed it and
+    returns max_d + 1 instead of the exact distance.
+    """
+    mask = (1 << len1) - 1
+    high = 1 << (len1 - 1)
+    pv, mv, d = mask, 0, len1
+    # Each remaining character of s2 can lower the distance by at most one
+    stop = len(s2) + max_d if max_d is not None else None
+    for k, ch in enumerate(s2, 1):
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            d += 1
+        elif mh & high:
+            d -= 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+        if stop is not None and d + k > stop:
+            return max_d + 1
+    return d
+
+
+def normalized_levenshtein(s1: str, s2: str,
+                           max_ratio: Optional[float] = None,
+                           peq: Optional[Dict[str, int]] = None) -> float:
+    """Levenshtein distance of s1 and s2 over the longer length.
+
+    With max_ratio set, only values below it are exact; the rest come back
+    as 1.0. peq, if given, is lev_pattern(s1), so one pattern can serve
+    many s2.
+    """
     if s1 == s2:
         return 0.0
     if not s1 or not s2:
         return 1.0
 
     len1, len2 = len(s1), len(s2)
-    prev = list(range(len2 + 1))
-    curr = [0] * (len2 + 1)
-
-    for i in range(1, len1 + 1):
-        curr[0] = i
-        c1 = s1[i - 1]
-        for j in range(1, len2 + 1):
-            cost = 0 if c1 == s2[j - 1] else 1
-            curr[j] = min(
-                prev[j] + 1,
-                curr[j - 1] + 1,
-                prev[j - 1] + cost
-            )
-        prev, curr = curr, prev
-
-    ld = prev[len2]
-    return ld / float(max(len1, len2))
+    m = float(max(len1, len2))
+    max_d = None
+    if max_ratio is not None:
+        # Largest distance whose normalized value is still below max_ratio
+        max_d = math.ceil(max_ratio * m)
+        while max_d >= 0 and max_d / m >= max_ratio:
+            max_d -= 1
+        # The distance is at least the length difference
+        if abs(len1 - len2) > max_d:
+            return 1.0
+
+    if peq is None:
+        peq = lev_pattern(s1)
+    ld = lev_bits(peq, len1, s2, max_d)
+    if max_d is not None and ld > max_d:
+        return 1.0
+    return ld / m
 
 
 # -------------------- Range Thinning (Algorithm 1) ----------------- #
@@ -118,31 +155,76 @@ def thin_change_relation(
     lev_threshold: float,
     mapping: Dict[int, int]
 ) -> None:
+    # Each step picks the closest pair left in the block (ties to the
+    # smallest l + r, then the smallest l) and shrinks the block to the
+    # lines after it. Only pairs under the threshold can ever be picked, and
+    # a pair outside the block never re-enters it, so one pass over those
+    # pairs in that order makes the same picks as rescanning every step.
+    candidates: List[Tuple[float, int, int, int]] = []
+    for l in range(lstart, lend):
+        s1 = old_lines[l]
+        # One bit pattern of the old line serves the whole row of the block
+        peq = lev_pattern(s1)
+        for r in range(rstart, rend):
+            d = normalized_levenshtein(s1, new_lines[r], lev_threshold, peq)
+            if d < lev_threshold:
+                candidates.append((d, l + r, l, r))
+    candidates.sort()
+
     sl = lstart
     sr = rstart
+    for _, _, l, r in candidates:
+        if l >= sl and r >= sr:
+            mapping[l] = r
+            sl = l + 1
+            sr = r + 1
 
-    while sl < lend and sr < rend:
-        best_l = best_r = None
-        best_d = None
 
-        for l in range(sl, lend):
-            s1 = old_lines[l]
-            for r in range(sr, rend):
-                s2 = new_lines[r]
-                d = normalized_levenshtein(s1, s2)
-                if best_d is None or d < best_d - 1e-9:
-                    best_d = d
-                    best_l, best_r = l, r
-                elif best_d is not None and abs(d - best_d) < 1e-9:
-                    if (l + r) < (best_l + best_r):
-                        best_l, best_r = l, r
+_worker_args = None
 
-        if best_d is None or best_d >= lev_threshold:
-            break
 
-        mapping[best_l] = best_r
-        sl = best_l + 1
-        sr = best_r + 1
+def _init_worker(old_lines: List[str], new_lines: List[str],
+                 lev_threshold: float) -> None:
+    global _worker_args
+    _worker_args = (old_lines, new_lines, lev_threshold)
+
+
+def _thin_worker(pair: Tuple[Tuple[int, int], Tuple[int, int]]) -> Dict[int, int]:
+    (lstart, lend), (rstart, rend) = pair
+    part: Dict[int, int] = {}
+    thin_change_relation(lstart, lend, rstart, rend, *_worker_args, part)
+    return part
+
+
+def thin_range_pairs(
+    pairs: List[Tuple[Tuple[int, int], Tuple[int, int]]],
+    old_lines: List[str],
+    new_lines: List[str],
+    lev_threshold: float,
+    mapping: Dict[int, int]
+) -> None:
+    """thin_change_relation() for each (deletion, addition) range pair in
+    order, spread over all CPUs when the blocks hold enough line pairs."""
+    workers = os.cpu_count() or 1
+    cells = sum((lend - lstart) * (rend - rstart)
+                for (lstart, lend), (rstart, rend) in pairs)
+    if cells < PARALLEL_MIN_CELLS or workers < 2:
+        for (lstart, lend), (rstart, rend) in pairs:
+            thin_change_relation(
+                lstart, lend, rstart, rend,
+                old_lines, new_lines,
+                lev_threshold,
+                mapping
+            )
+        return
+
+    # Each pair only reads the lines, so the pairs can be thinned apart;
+    # merging in order keeps later pairs overriding earlier ones.
+    chunksize = max(1, len(pairs) // (4 * workers))
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(old_lines, new_lines, lev_threshold)) as ex:
+        for part in ex.map(_thin_worker, pairs, chunksize=chunksize):
+            mapping.update(part)
 
 
 # ---------------------- Main ldiff Procedure ----------------------- #
@@ -153,7 +235,10 @@ def ldiff(
     cosine_threshold: float = 0.0,
     lev_threshold: float = 0.4
 ) -> Dict[int, int]:
-    sm = difflib.SequenceMatcher(None, old_lines, new_lines)
+    ids: Dict[str, int] = {}
+    old_ids = [ids.setdefault(line, len(ids)) for line in old_lines]
+    new_ids = [ids.setdefault(line, len(ids)) for line in new_lines]
+    sm = difflib.SequenceMatcher(None, old_ids, new_ids)
     opcodes = sm.get_opcodes()
 
     mapping: Dict[int, int] = {}
@@ -177,21 +262,30 @@ def ldiff(
     del_vecs = build_tfidf_vectors(deletion_ranges, old_lines)
     add_vecs = build_tfidf_vectors(addition_ranges, new_lines)
 
+    # Inverted index of the addition ranges' weights: one sweep over a
+    # deletion range's tokens gives its dot product with every addition
+    # range at once, like a row of a sparse matrix product
+    postings: Dict[str, List[Tuple[int, float]]] = {}
+    for k, a_range in enumerate(addition_ranges):
+        for t, w in add_vecs[a_range][0].items():
+            postings.setdefault(t, []).append((k, w))
+    add_norms = [add_vecs[a_range][1] for a_range in addition_ranges]
+
+    pairs: List[Tuple[Tuple[int, int], Tuple[int, int]]] = []
     for d_range in deletion_ranges:
-        d_vec = del_vecs[d_range]
-        for a_range in addition_ranges:
-            a_vec = add_vecs[a_range]
-            sim = cosine_similarity(d_vec, a_vec)
+        d_weights, d_norm = del_vecs[d_range]
+        dots: Dict[int, float] = {}
+        for t, w in d_weights.items():
+            for k, w2 in postings.get(t, ()):
+                dots[k] = dots.get(k, 0.0) + w * w2
+        for k, a_range in enumerate(addition_ranges):
+            dot = dots.get(k)
+            # Ranges that share no token have a cosine of exactly 0
+            sim = dot / (d_norm * add_norms[k]) if dot is not None else 0.0
             if sim > cosine_threshold:
-                lstart, lend = d_range
-                rstart, rend = a_range
-                thin_change_relation(
-                    lstart, lend, rstart, rend,
-                    old_lines, new_lines,
-                    lev_threshold,
-                    mapping
-                )
+                pairs.append((d_range, a_range))
 
+    thin_range_pairs(pairs, old_lines, new_lines, lev_threshold, mapping)
     return mapping
 
 